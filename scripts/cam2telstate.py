@@ -11,7 +11,10 @@ import re
 import json
 import asyncio
 import uuid
-from typing import List, Tuple, Dict, Set, Callable, Mapping, MutableMapping, Optional, Union, Any
+from typing import (
+    List, Tuple, Dict, Set, Callable, Mapping, MutableMapping, Optional, Union, Any,
+    Iterable, Iterator, AsyncIterator
+)
 
 import numpy as np
 import katsdptelstate
@@ -22,16 +25,42 @@ import aiokatcp
 import katsdpcam2telstate
 
 
+_BITMASK_RE = re.compile(r'\A[01]*\Z')
+_TEMPLATE_KEY_RE = re.compile(r'\$\{([^}]+)\}')
+_RECEPTOR_RE = re.compile(r'\A[a-zA-Z]\d+\Z')
+_DOUBLE_UNDERSCORES_RE = re.compile(r'__+')
+# Numbers and lists of numbers, for which JSON and Python literal syntax agree
+_NUMERIC_JSON_RE = re.compile(r'\A[-\d\[][-+\d.eE\[\],\s]*\Z')
+
+
 def comma_split(value: str) -> List[str]:
     return value.split(',')
 
 
+def convert_literal(value: str) -> Any:
+    """Parse a Python literal with :func:`numpy.safe_eval`.
+
+    Plain numbers and (nested) lists of numbers are parsed with
+    :func:`json.loads` instead, which is much faster and gives the same result
+    for them. Anything else, including NaN and true/false/null, is left to
+    :func:`numpy.safe_eval`.
+    """
+    if isinstance(value, str) and _NUMERIC_JSON_RE.match(value):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return np.safe_eval(value)
+
+
 def convert_bitmask(value: object) -> np.ndarray:
     """Converts a string of 1's and 0's to a numpy array of bools"""
-    if not isinstance(value, str) or not re.match('^[01]*$', value):
+    if not isinstance(value, str) or not _BITMASK_RE.match(value):
         return None
     else:
-        return np.array([c == '1' for c in value])
+        # The regex guarantees the string is pure ASCII
+        buf = np.frombuffer(value.encode('ascii'), dtype=np.uint8)
+        return buf == ord('1')
 
 
 class Template(string.Template):
@@ -66,6 +95,9 @@ class Sensor:
         If true, don't report an error if the sensor isn't present. This is
         used for sensors that only exist in some CBF systems but not all.
     """
+    __slots__ = ('cam_name', 'sdp_name', 'sampling_strategy_and_params', 'immutable',
+                 'convert', 'ignore_missing', 'waiting')
+
     def __init__(self, cam_name: str, sdp_name: Union[None, str, List[str]] = None,
                  sampling_strategy_and_params: str = 'event',
                  immutable: bool = False,
@@ -79,8 +111,9 @@ class Sensor:
         self.ignore_missing = ignore_missing
         self.waiting = True     #: Waiting for an initial value
 
-    def expand(self, substitutions: Mapping[str, List[Tuple[str, List[str]]]]) -> List['Sensor']:
-        """Expand a template into a list of sensors. The sensor name may
+    def expand(self, substitutions: Mapping[str, List[Tuple[str, List[str]]]]
+               ) -> Iterator['Sensor']:
+        """Expand a template into a sequence of sensors. The sensor name may
         contain keys in braces. These are looked up in `substitutions` and
         replaced with each possible value to form the new sensors, taking the
         Cartesian product if there are multiple keys.
@@ -99,37 +132,36 @@ class Sensor:
         KeyError
             if a key is used in `sdp_name` but not in `cam_name`
         """
-        def substitute(name, params):
+        def substitute(template, params):
             """Expand a template with parameters.
 
             Also eliminates doubled, leading and trailing underscores from the result.
             """
-            name = Template(name).substitute(params)
-            parts = [part for part in name.split('_') if part]
-            return '_'.join(parts)
+            name = template.substitute(params)
+            if '__' in name:
+                name = _DOUBLE_UNDERSCORES_RE.sub('_', name)
+            return name.strip('_')
 
-        keys = list(set(re.findall(r'\$\{([^}]+)\}', self.cam_name)))
+        assert isinstance(self.sdp_name, str)
+        keys = tuple(set(_TEMPLATE_KEY_RE.findall(self.cam_name)))
         iters = [substitutions[key] for key in keys]
-        ans = []
+        cam_template = Template(self.cam_name)
+        sdp_template = Template(self.sdp_name)
         for values in itertools.product(*iters):
-            cam_dict = {key: value[0] for key, value in zip(keys, values)}
-            sdp_dict = {key: value[1] for key, value in zip(keys, values)}
-            sdp_names = []
-            # sdp_dict maps each key to a list of values to substitute.
+            cam_values = [value[0] for value in values]
+            # Each sdp value is a list of values to substitute.
             # Check that they are lists and not a single string.
-            for value in sdp_dict.values():
-                assert isinstance(value, list)
-            for sdp_values in itertools.product(*sdp_dict.values()):
-                # Recombine this specific set of values with the keys
-                sdp_single_dict = dict(zip(sdp_dict.keys(), sdp_values))
-                sdp_names.append(substitute(self.sdp_name, sdp_single_dict))
-            ans.append(Sensor(substitute(self.cam_name, cam_dict),
-                              sdp_names,
-                              self.sampling_strategy_and_params,
-                              self.immutable,
-                              self.convert,
-                              self.ignore_missing))
-        return ans
+            sdp_lists = [value[1] for value in values]
+            for sdp_list in sdp_lists:
+                assert isinstance(sdp_list, list)
+            sdp_names = [substitute(sdp_template, dict(zip(keys, sdp_values)))
+                         for sdp_values in itertools.product(*sdp_lists)]
+            yield Sensor(substitute(cam_template, dict(zip(keys, cam_values))),
+                         sdp_names,
+                         self.sampling_strategy_and_params,
+                         self.immutable,
+                         self.convert,
+                         self.ignore_missing)
 
 
 STREAM_TYPES = {
@@ -227,21 +259,21 @@ SENSORS = [
            sdp_name='${stream.cbf.antenna_channelised_voltage}_fft_shift',
            ignore_missing=True),
     Sensor('${stream.cbf.antenna_channelised_voltage}_${inputn}_delay',
-           ignore_missing=True, convert=np.safe_eval),
+           ignore_missing=True, convert=convert_literal),
     Sensor('${stream.cbf.antenna_channelised_voltage}_${inputn}_eq',
-           ignore_missing=True, convert=np.safe_eval),
+           ignore_missing=True, convert=convert_literal),
     # baseline correlation products stream
     Sensor('${sub_stream.cbf.baseline_correlation_products}_bandwidth', immutable=True),
     Sensor('${stream.cbf.baseline_correlation_products}_bls_ordering',
-           immutable=True, convert=np.safe_eval),
+           immutable=True, convert=convert_literal),
     Sensor('${stream.cbf.baseline_correlation_products}_int_time', immutable=True),
     Sensor('${stream.cbf.baseline_correlation_products}_n_accs', immutable=True),
     Sensor('${stream.cbf.baseline_correlation_products}_n_chans_per_substream', immutable=True),
     # tied-array channelised voltage stream
     Sensor('${sub_stream.cbf.tied_array_channelised_voltage}_bandwidth', immutable=True),
     Sensor('${stream.cbf.tied_array_channelised_voltage}_source_indices',
-           immutable=True, convert=np.safe_eval),
-    Sensor('${stream.cbf.tied_array_channelised_voltage}_weight', convert=np.safe_eval),
+           immutable=True, convert=convert_literal),
+    Sensor('${stream.cbf.tied_array_channelised_voltage}_weight', convert=convert_literal),
     Sensor('${stream.cbf.tied_array_channelised_voltage}_n_chans_per_substream', immutable=True),
     Sensor('${stream.cbf.tied_array_channelised_voltage}_spectra_per_heap', immutable=True),
     #
@@ -286,6 +318,30 @@ SENSORS = [
 ]
 
 
+def _check_templates(templates: Iterable[Sensor]) -> None:
+    """Check that no template uses keys in `sdp_name` that are not in `cam_name`.
+
+    This is run on :data:`SENSORS` at import time, so that a mistake in a
+    template is reported immediately rather than when it is expanded.
+
+    Raises
+    ------
+    KeyError
+        if a key is used in `sdp_name` but not in `cam_name`
+    """
+    for template in templates:
+        assert isinstance(template.sdp_name, str)
+        cam_keys = set(_TEMPLATE_KEY_RE.findall(template.cam_name))
+        sdp_keys = set(_TEMPLATE_KEY_RE.findall(template.sdp_name))
+        missing = sdp_keys - cam_keys
+        if missing:
+            raise KeyError('sdp_name {} uses keys not in cam_name: {}'.format(
+                template.sdp_name, ', '.join(sorted(missing))))
+
+
+_check_templates(SENSORS)
+
+
 def parse_args() -> argparse.Namespace:
     parser = katsdpservices.ArgumentParser()
     parser.add_argument('--url', type=str, help='WebSocket URL to connect to')
@@ -377,29 +433,26 @@ class Client:
         if self._args.receptors is not None:
             return self._args.receptors.split(',')
         value = await self.get_sensor_value('{}_pool_resources'.format(self._sub_name))
-        resources = value.split(',')
-        receptors = []
-        for resource in resources:
-            if re.match(r'^[a-zA-Z]\d+$', resource):
-                receptors.append(resource)
-        return receptors
-
-    async def get_sensors(self) -> List[Sensor]:
-        """Get list of sensors to be collected from CAM.
-
-        Returns
-        -------
-        sensors : list of `Sensor`
+        return [resource for resource in value.split(',') if _RECEPTOR_RE.match(resource)]
+
+    async def get_sensors(self) -> AsyncIterator[Sensor]:
+        """Get sensors to be collected from CAM.
+
+        Yields
+        ------
+        sensor : `Sensor`
         """
         # Tell mypy that these must have been initialised
         assert self._sub_name is not None
         assert self._cbf_name is not None
         assert self._sdp_name is not None
 
-        receptors = await self.get_receptors()
-        input_labels = await self.get_sensor_value('{}_input_labels'.format(self._cbf_name))
+        # These are independent, so fetch them in parallel
+        receptors, input_labels, band = await asyncio.gather(
+            self.get_receptors(),
+            self.get_sensor_value('{}_input_labels'.format(self._cbf_name)),
+            self.get_sensor_value('{}_band'.format(self._sub_name)))
         input_labels = input_labels.split(',')
-        band = await self.get_sensor_value('{}_band'.format(self._sub_name))
 
         rx_name = 'rsc_rx{}'.format(band)
         dig_name = 'dig_{}_band'.format(band)
@@ -422,48 +475,79 @@ class Client:
             substitutions['sub_stream.' + stream_type] = []
 
         cam_prefix = self._cbf_name
+        inputn_subs = substitutions['inputn']
         for (number, name) in enumerate(input_labels):
             # input{} is the old version, input name is the new version. For
             # now try with both and one of them won't exist.
-            substitutions['inputn'].append(('input{}'.format(number), [name]))
-            substitutions['inputn'].append((name, [name]))
+            inputn_subs.append(('input{}'.format(number), [name]))
+            inputn_subs.append((name, [name]))
         # Add the per instrument specific sensors for every instrument we know about
+        instrument_subs = substitutions['instrument']
         for instrument in self._instruments:
             cam_instrument = "{}_{}".format(cam_prefix, instrument)
             sdp_instruments = [instrument]
-            substitutions['instrument'].append((cam_instrument, sdp_instruments))
+            instrument_subs.append((cam_instrument, sdp_instruments))
         # For each stream we add type specific sensors
+        stream_subs = substitutions['stream']
+        sub_stream_subs = substitutions['sub_stream']
+        beam_inputn_subs = substitutions['stream.cbf.tied_array_channelised_voltage.inputn']
         for (full_stream_name, stream_type) in self._streams_with_type.items():
             if stream_type not in STREAM_TYPES:
                 self._logger.warning('Skipping stream %s with unknown type %s',
                                      full_stream_name, stream_type)
+                continue
             cam_stream = "{}_{}".format(cam_prefix, full_stream_name)
             cam_sub_stream = "{}_streams_{}".format(self._sub_name, full_stream_name)
             sdp_streams = [full_stream_name]
-            substitutions['stream'].append((cam_stream, sdp_streams))
+            stream_subs.append((cam_stream, sdp_streams))
             substitutions['stream.' + stream_type].append((cam_stream, sdp_streams))
-            substitutions['sub_stream'].append((cam_sub_stream, sdp_streams))
+            sub_stream_subs.append((cam_sub_stream, sdp_streams))
             substitutions['sub_stream.' + stream_type].append((cam_sub_stream, sdp_streams))
             # tied-array-channelised-voltage per-input sensors are special:
             # only a subset of the inputs are used and only the corresponding
             # sensors exist.
             if stream_type == 'cbf.tied_array_channelised_voltage':
                 source_indices = await self.get_sensor_value(cam_stream + '_source_indices')
-                source_indices = np.safe_eval(source_indices)
-                sublist = substitutions['stream.{}.inputn'.format(stream_type)]
+                source_indices = convert_literal(source_indices)
                 for index in source_indices:
                     if 0 <= index < len(input_labels):
                         name = '{}_{}'.format(full_stream_name, input_labels[index])
-                        sublist.append(('{}_input{}'.format(cam_stream, index), [name]))
+                        beam_inputn_subs.append(('{}_input{}'.format(cam_stream, index), [name]))
                     else:
                         self._logger.warning('Out of range source index %d on %s',
                                              index, full_stream_name)
 
-        sensors: List[Sensor] = []
         for template in SENSORS:
-            expanded = template.expand(substitutions)
-            sensors.extend(expanded)
-        return sensors
+            for sensor in template.expand(substitutions):
+                yield sensor
+
+    async def set_sampling_strategy(self, strategy: str, sensors: List[Sensor]) -> None:
+        """Set the same sampling strategy on a group of sensors with a single request.
+
+        Sensors for which the strategy could not be set (including those that
+        don't exist) are no longer waited for.
+        """
+        assert self._portal_client is not None
+        assert self._sensors is not None
+        regex = '^(?:' + '|'.join(re.escape(sensor.cam_name) for sensor in sensors) + ')$'
+        status = await self._portal_client.set_sampling_strategies(
+            self.namespace, regex, strategy)
+        for (sensor_name, result) in sorted(status.items()):
+            if result['success']:
+                self._logger.info("Set sampling strategy on %s to %s",
+                                  sensor_name, strategy)
+            else:
+                self._logger.error("Failed to set sampling strategy on %s: %s",
+                                   sensor_name, result['info'])
+                # Not going to get any values, so don't wait for it
+                self._waiting -= 1
+                self._sensors[sensor_name].waiting = False
+        for sensor in sensors:
+            if sensor.cam_name not in status:
+                if not sensor.ignore_missing:
+                    self._logger.error("Sensor %s not found", sensor.cam_name)
+                self._waiting -= 1
+                sensor.waiting = False
 
     async def start(self) -> None:
         try:
@@ -481,8 +565,7 @@ class Client:
             self._sdp_name = await self._portal_client.sensor_subarray_lookup('sdp', '')
             self._logger.info('Initialising')
             # Now we can tell which sensors to subscribe to
-            sensors = await self.get_sensors()
-            self._sensors = {x.cam_name: x for x in sensors}
+            self._sensors = {x.cam_name: x async for x in self.get_sensors()}
 
             self._waiting = len(self._sensors)
             status = await self._portal_client.subscribe(
@@ -491,30 +574,11 @@ class Client:
 
             # Group sensors by strategy to bulk-set sampling strategies
             by_strategy: MutableMapping[str, List[Sensor]] = collections.defaultdict(list)
-            for sensor in sensors:
+            for sensor in self._sensors.values():
                 by_strategy[sensor.sampling_strategy_and_params].append(sensor)
-            for (strategy, strategy_sensors) in by_strategy.items():
-                strategy = strategy.format(period=self._period)
-                regex = '^(?:' + '|'.join(re.escape(sensor.cam_name)
-                                          for sensor in strategy_sensors) + ')$'
-                status = await self._portal_client.set_sampling_strategies(
-                    self.namespace, regex, strategy)
-                for (sensor_name, result) in sorted(status.items()):
-                    if result['success']:
-                        self._logger.info("Set sampling strategy on %s to %s",
-                                          sensor_name, strategy)
-                    else:
-                        self._logger.error("Failed to set sampling strategy on %s: %s",
-                                           sensor_name, result['info'])
-                        # Not going to get any values, so don't wait for it
-                        self._waiting -= 1
-                        self._sensors[sensor_name].waiting = False
-                for sensor in strategy_sensors:
-                    if sensor.cam_name not in status:
-                        if not sensor.ignore_missing:
-                            self._logger.error("Sensor %s not found", sensor.cam_name)
-                        self._waiting -= 1
-                        sensor.waiting = False
+            await asyncio.gather(*(
+                self.set_sampling_strategy(strategy.format(period=self._period), strategy_sensors)
+                for (strategy, strategy_sensors) in by_strategy.items()))
 
             loop = asyncio.get_event_loop()
             for signal_number in [signal.SIGINT, signal.SIGTERM]:
@@ -536,15 +600,15 @@ class Client:
     def sensor_update(self, sensor: Sensor, value: Any, status: str, timestamp: float) -> None:
         name = sensor.cam_name
         if status not in STATUS_VALID_VALUE:
-            self._logger.info("Sensor {} received update '{}' with status '{}' (ignored)"
-                              .format(name, value, status))
+            self._logger.info("Sensor %s received update '%s' with status '%s' (ignored)",
+                              name, value, status)
             return
         try:
             if sensor.convert is not None:
                 value = sensor.convert(value)
         except Exception:
-            self._logger.warn('Failed to convert %s, ignoring (value was %r)',
-                              name, value, exc_info=True)
+            self._logger.warning('Failed to convert %s, ignoring (value was %r)',
+                                 name, value, exc_info=True)
             return
         sdp_names = sensor.sdp_name
         if not isinstance(sdp_names, list):
@@ -559,22 +623,18 @@ class Client:
                                    name, value, timestamp, exc_info=True)
 
     def process_update(self, item: Mapping[str, Any]) -> None:
-        self._logger.debug("Received update %s", pprint.pformat(item))
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("Received update %s", pprint.pformat(item))
         data = item['msg_data']
-        if data is None:
+        if data is None or self._sensors is None:   # self._sensors is None while bootstrapping
             return
         name = data['name']
-        timestamp = data['timestamp']
-        status = data['status']
         value = data['value']
-
-        if self._sensors is None:   # We are still bootstrapping
-            return
-        if name not in self._sensors:
-            self._logger.warn("Sensor {} received update '{}' but we didn't subscribe (ignored)"
-                              .format(name, value))
+        sensor = self._sensors.get(name)
+        if sensor is None:
+            self._logger.warning("Sensor %s received update '%s' but we didn't subscribe (ignored)",
+                                 name, value)
         else:
-            sensor = self._sensors[name]
             last = False
             if sensor.waiting:
                 sensor.waiting = False
@@ -582,7 +642,7 @@ class Client:
                 if self._waiting == 0:
                     last = True
             try:
-                self.sensor_update(sensor, value, status, timestamp)
+                self.sensor_update(sensor, value, data['status'], data['timestamp'])
             finally:
                 if last:
                     self._logger.info('Initial values for all sensors seen, starting katcp server')
@@ -590,7 +650,8 @@ class Client:
                     asyncio.get_event_loop().create_task(self._device_server.start())
 
     def update_callback(self, msg: Union[Dict[str, Any], List[Dict[str, Any]]]) -> None:
-        self._logger.debug("update_callback: %s", pprint.pformat(msg))
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("update_callback: %s", pprint.pformat(msg))
         if isinstance(msg, list):
             for item in msg:
                 self.process_update(item)